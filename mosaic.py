@@ -1,7 +1,7 @@
 import time
-import itertools
-import random
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from PIL import Image
@@ -9,13 +9,98 @@ from skimage import img_as_float
 from skimage.measure import compare_mse
 from tqdm import tqdm
 
-def shuffle_first_items(lst, i):
-    if not i:
-        return lst
-    first_few = lst[:i]
-    remaining = lst[i:]
-    random.shuffle(first_few) 
-    return first_few + remaining
+MATCH_CANDIDATES = 64 # best matches kept per sector, more are only ranked when these run out
+MATCH_CHUNK_BYTES = 2**27 # float32 distances (and tile data) computed per matching step, bounds peak memory
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, fall back to plain python
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+try:
+    import faiss
+except ImportError:
+    # faiss is optional and only used when Config.use_faiss is set
+    faiss = None
+
+@njit(cache=True)
+def greedy_assign(sorted_idx, avail, group_size, selected, start):
+    """
+    Give every sector from row start on, in order, its best ranked tile
+    that is still available, and retire that tile together with its
+    rotated copies (groups of group_size consecutive tiles). Choices are
+    written to selected. Stops at the first sector whose ranked tiles are
+    all taken and returns its row, or the number of rows if none is.
+    """
+    for i in range(start, sorted_idx.shape[0]):
+        found = False
+        for r in range(sorted_idx.shape[1]):
+            j = sorted_idx[i, r]
+            if avail[j]:
+                selected[i] = j
+                g = (j // group_size) * group_size
+                avail[g:g + group_size] = False
+                found = True
+                break
+        if not found:
+            return i
+    return sorted_idx.shape[0]
+
+def best_ranked(distances, k):
+    """
+    Indices of the k smallest distances along the last axis, best first.
+    Partitioning first keeps this linear in the number of tiles.
+    """
+    if k >= distances.shape[-1]:
+        return distances.argsort(axis=-1)
+    if k == 1:
+        return distances.argmin(axis=-1)[..., None]
+    top = np.argpartition(distances, k - 1, axis=-1)[..., :k]
+    return np.take_along_axis(top, np.take_along_axis(distances, top, axis=-1).argsort(axis=-1), axis=-1)
+
+def rotation_maps(size, count):
+    """
+    Pixel correspondences for rotating an image of the given (width, height)
+    by multiples of 90 degrees exactly as Image.rotate does. For each of the
+    count rotations returns (source, target) index arrays such that pixel
+    target[e] of the rotated image is pixel source[e] of the original, with
+    all other pixels of the rotated image left empty.
+    """
+    width, height = size
+    index = Image.fromarray(np.arange(1, width * height + 1, dtype=np.int32).reshape(height, width))
+    maps = list()
+    for k in range(count):
+        rotated = np.asarray(index.rotate(90 * k)).ravel() - 1
+        target = np.flatnonzero(rotated >= 0)
+        maps.append((rotated[target], target))
+    return maps
+
+def downsample(img, size, mode):
+    """
+    Shrink img to size (width, height) as a uint8 array in the given color
+    mode. It is resized once to a whole multiple of size and every block of
+    pixels is then averaged in numpy.
+    """
+    width, height = size
+    k = max(1, min(img.size[0] // width, img.size[1] // height))
+    arr = np.asarray(img.resize((width * k, height * k), Image.BILINEAR).convert(mode))
+    small = arr.reshape(height, k, width, k, -1).mean((1, 3))
+    return np.rint(small).astype(np.uint8).reshape((height, width) + arr.shape[2:])
+
+def morton_order(xs, ys):
+    """
+    Indices that sort the (x, y) grid positions along a Z-order curve,
+    so that consecutive positions stay close together in both directions.
+    """
+    def spread_bits(v):
+        v = v.astype(np.uint64)
+        for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                            (2, 0x3333333333333333), (1, 0x5555555555555555)):
+            v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+        return v
+    return np.argsort(spread_bits(xs) | (spread_bits(ys) << np.uint64(1)), kind='stable')
 
 def bound(low, high, value):
     return max(low, min(high, value))
@@ -78,13 +163,14 @@ def aspect_crop_to_extent(img, target_aspect, centerpoint=None):
     return img.crop(resize)
 
 class Config:
-    def __init__(self, tile_ratio=1920/800, tile_width=50, match_width = 20, enlargement=8, color_mode='RGB', rotate=False):
+    def __init__(self, tile_ratio=1920/800, tile_width=50, match_width = 20, enlargement=8, color_mode='RGB', rotate=False, use_faiss=False):
         self.tile_ratio = tile_ratio # 2.4
         self.match_width = match_width
         self.tile_width = tile_width # height/width of mosaic tiles in pixels
         self.enlargement = enlargement # mosaic image will be this many times wider and taller than original
         self.color_mode = color_mode # mosaic image will be this many times wider and taller than original
         self.rotate = rotate 
+        self.use_faiss = use_faiss # search tiles with a FAISS index instead of chunked numpy
 
     @property
     def tile_height(self):
@@ -94,6 +180,10 @@ class Config:
     def tile_size(self):
         return self.tile_width, self.tile_height # PIL expects (width, height)
 
+    @property
+    def match_size(self):
+        return self.match_width, int(self.match_width / self.tile_ratio) # PIL expects (width, height)
+
 class TileBox:
     """
     Container to import, process, hold, and compare all of the tiles 
@@ -102,38 +192,198 @@ class TileBox:
     def __init__(self, tile_paths, config):
         self.config = config
         self.tiles = list()
+        # Rotated tiles are not stored, instead the blocks are rotated the
+        # other way while matching. Match candidate c is tile c // rotations
+        # turned by 90 * (c % rotations) degrees.
+        self.rotations = 4 if self.config.rotate else 1
         self.prepare_tiles_from_paths(tile_paths)
         
     def __process_tile(self, tile_path):
         with Image.open(tile_path) as i:
             img = i.copy()
         img = aspect_crop_to_extent(img, self.config.tile_ratio)
-        large_tile_img = img.resize(self.config.tile_size, Image.ANTIALIAS).convert(self.config.color_mode)
-        self.tiles.append(large_tile_img)
-        if self.config.rotate:
-            for i in range(3):
-                self.tiles.append(large_tile_img.rotate(90 * (1+i)))
-        return True
+        large_tile_img = img.resize(self.config.tile_size, Image.LANCZOS).convert(self.config.color_mode)
+        return large_tile_img, downsample(large_tile_img, self.config.match_size, self.config.color_mode)
 
     def prepare_tiles_from_paths(self, tile_paths):
         print('Reading tiles from provided list...')
-        #progress = ProgressCounter(len(tile_paths))
-        for tile_path in tqdm(tile_paths):
-            #progress.update()
-            self.__process_tile(tile_path)
-        print('Rescaling tiles for matching...')
-        
-        match_size = self.config.match_width, int(self.config.match_width / self.config.tile_ratio)
-        print(match_size)
-        self.tile_array = np.array([np.array(t.resize(match_size,Image.NEAREST)) for t in self.tiles]).astype("float32")
+        # PIL releases the GIL while decoding and resizing, so threads are enough
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = list(tqdm(executor.map(self.__process_tile, tile_paths), total=len(tile_paths)))
+        self.tiles = [large_tile_img for large_tile_img, _ in results]
+        tile_array = np.array([small_tile for _, small_tile in results])
+        # Flattened once so matching is a single matrix product, kept as
+        # uint8 pixels which is a quarter of the memory of float32
+        self.tile_u8 = np.ascontiguousarray(tile_array.reshape(len(self.tiles), -1), dtype=np.uint8)
+        self.__prepare_matching()
         print('Processed tiles.')
         return True
 
+    def __prepare_matching(self):
+        match_size = self.config.match_size
+        channels = self.tile_u8.shape[1] // (match_size[0] * match_size[1])
+        self.rotation_maps = list()
+        masks = np.zeros((self.rotations, self.tile_u8.shape[1]), dtype=np.int64)
+        for k, (source, target) in enumerate(rotation_maps(match_size, self.rotations)):
+            source = (source[:, None] * channels + np.arange(channels)).ravel()
+            target = (target[:, None] * channels + np.arange(channels)).ravel()
+            self.rotation_maps.append((source, target))
+            masks[k, source] = 1
+        # Squared norm of the part of each tile that is still visible when rotated, shape (rotations, tiles)
+        # summed straight from the uint8 pixels, without an int64 copy of the tile array
+        self.tile_sqnorms = np.einsum('kd,nd,nd->kn', masks, self.tile_u8, self.tile_u8, dtype=np.int64)
+        # Plain L2 search only applies when no rotation cuts off part of the tile
+        self.__full_rotations = bool(masks.all())
+        self.__faiss_index = None
+        if self.config.use_faiss and faiss is None:
+            raise ImportError('use_faiss needs the faiss package (pip install faiss-cpu)')
+        if self.rotations == 1:
+            # Fixed for the lifetime of the TileBox, so pick the method once here
+            self.__rotate_blocks = self.__unrotated_blocks
+
+    def save(self, directory):
+        """
+        Cache the processed tiles as .npy files, so that other processes
+        can load them instead of reading and resizing every tile again.
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'tiles.npy'), np.stack([np.asarray(t) for t in self.tiles]))
+        np.save(os.path.join(directory, 'tiles_match.npy'), self.tile_u8)
+
+    @classmethod
+    def load(cls, directory, config, mmap_mode='r'):
+        """
+        Load tiles cached by save, made with the same config. Both arrays
+        are memory mapped by default, so processes loading the same cache
+        share their pages through the page cache. The full size tiles stay
+        as rows of the memory map and only become images in get_tile.
+        """
+        tile_box = cls.__new__(cls)
+        tile_box.config = config
+        tile_box.rotations = 4 if config.rotate else 1
+        tile_box.tiles = list(np.load(os.path.join(directory, 'tiles.npy'), mmap_mode=mmap_mode))
+        tile_box.tile_u8 = np.load(os.path.join(directory, 'tiles_match.npy'), mmap_mode=mmap_mode)
+        tile_box.__prepare_matching()
+        return tile_box
+
+    def get_tile(self, c):
+        """The full size tile image for match candidate c."""
+        n, k = divmod(c, self.rotations)
+        tile = self.tiles[n]
+        if isinstance(tile, np.ndarray):
+            # Loaded from a cache, turn this row of the memory map into an image only now
+            tile = Image.fromarray(tile)
+        if k:
+            return tile.rotate(90 * k)
+        return tile
+
+    def __rotate_blocks(self, query, dtype):
+        """
+        Turn flattened blocks of shape (blocks, pixels) back by every tile
+        rotation, so that comparing a tile against the k-th result equals
+        comparing the k-th rotation of that tile against the block.
+        The blocks are cast to dtype while being copied.
+        """
+        rotated = np.zeros((self.rotations,) + query.shape, dtype=dtype)
+        for k, (source, target) in enumerate(self.rotation_maps):
+            rotated[k][:, source] = query[:, target]
+        return rotated
+
+    def __unrotated_blocks(self, query, dtype):
+        """__rotate_blocks without rotations, where the blocks only need casting."""
+        return query.astype(dtype, copy=False)[None]
+
     def best_tile_block_match(self, tile_block_original):
-        a = np.array(tile_block_original).astype("float32")
-        match_results = ((self.tile_array - a.reshape((1,) + a.shape) )**2).mean((1,2,3)) #[img_mse(t, tile_block_original) for t in self.tiles] 
-        #best_fit_tile_index = np.argmin(match_results)
-        return match_results.argsort() #best_fit_tile_index
+        if isinstance(tile_block_original, Image.Image):
+            # View the raw pixel bytes, the cast happens while rotating
+            a_flat = np.frombuffer(tile_block_original.tobytes(), dtype=np.uint8).reshape(1, -1)
+        else:
+            a_flat = np.asarray(tile_block_original).reshape(1, -1)
+        # Same chunked float32 path as the batched matching, so the tile array is never cast whole
+        return self.best_block_matches(a_flat, MATCH_CANDIDATES)[0]
+
+    def __tile_chunk(self, blocks):
+        """
+        Number of tiles matched per step, so that their float32 copy and
+        their distances to the given number of blocks fit MATCH_CHUNK_BYTES.
+        """
+        return max(1, MATCH_CHUNK_BYTES // (4 * (self.rotations * blocks + self.tile_u8.shape[1])))
+
+    def __chunk_distances(self, rotated, tiles):
+        """
+        Distances between rotated blocks and the tiles selected by tiles
+        (a slice or index array), as an array of shape (rotations, blocks,
+        tiles). All blocks are matched in one matrix product, done in
+        float32 as numpy has no BLAS kernels for integer types.
+        """
+        tile_array = self.tile_u8[tiles].astype(np.float32)
+        distances = (rotated.reshape(-1, rotated.shape[2]) @ tile_array.T).reshape(self.rotations, rotated.shape[1], -1)
+        distances *= -2.0
+        distances += self.tile_sqnorms[:, tiles].astype(np.float32)[:, None, :]
+        return distances
+
+    def best_available_match(self, block, available):
+        """
+        The best match candidate for a single block among those set in the
+        boolean available mask, or -1 if there are none. Only tiles with an
+        available rotation are compared, a chunk at a time.
+        """
+        rotated = self.__rotate_blocks(np.asarray(block).reshape(1, -1), np.float32)
+        available = available.reshape(-1, self.rotations)
+        open_tiles = np.flatnonzero(available.any(axis=1))
+        chunk = self.__tile_chunk(1)
+        best, best_distance = -1, np.inf
+        for start in range(0, len(open_tiles), chunk):
+            tiles = open_tiles[start:start + chunk]
+            distances = self.__chunk_distances(rotated, tiles)[:, 0].T
+            distances[~available[tiles]] = np.inf
+            i = distances.argmin()
+            if distances.flat[i] < best_distance:
+                best_distance = distances.flat[i]
+                best = tiles[i // self.rotations] * self.rotations + i % self.rotations
+        return best
+
+    def best_block_matches(self, blocks, k):
+        """
+        The k best match candidates for every block, best first, as an
+        array of shape (blocks, k). Tiles are matched a chunk at a time
+        against all blocks, which bounds memory to MATCH_CHUNK_BYTES
+        instead of the full distance matrix. The best k of each rotation
+        are taken from every chunk and merged into a running top k.
+        """
+        query = np.asarray(blocks).reshape(len(blocks), -1)
+        rotated = self.__rotate_blocks(query, np.float32)
+        if self.config.use_faiss and self.__full_rotations:
+            return self.__faiss_block_matches(rotated, k)
+        chunk = self.__tile_chunk(len(query))
+        best_distances = np.empty((len(query), 0), dtype=np.float32)
+        best = np.empty((len(query), 0), dtype=np.int64)
+        for start in range(0, len(self.tile_u8), chunk):
+            found_distances, found = [best_distances], [best]
+            for rotation, distances in enumerate(self.__chunk_distances(rotated, slice(start, start + chunk))):
+                top = best_ranked(distances, k)
+                found_distances.append(np.take_along_axis(distances, top, axis=1))
+                found.append((start + top) * self.rotations + rotation)
+            distances = np.concatenate(found_distances, axis=1)
+            top = best_ranked(distances, k)
+            best_distances = np.take_along_axis(distances, top, axis=1)
+            best = np.take_along_axis(np.concatenate(found, axis=1), top, axis=1)
+        return best
+
+    def __faiss_block_matches(self, rotated, k):
+        """
+        best_block_matches using an exact FAISS L2 index over the tiles,
+        searched once per rotation of the blocks. The index holds its own
+        float32 copy of the tiles, outside any memory mapped cache.
+        """
+        if self.__faiss_index is None:
+            self.__faiss_index = faiss.IndexFlatL2(self.tile_u8.shape[1])
+            self.__faiss_index.add(self.tile_u8.astype(np.float32))
+        results = [self.__faiss_index.search(np.ascontiguousarray(r), min(k, len(self.tile_u8))) for r in rotated]
+        # (blocks, found, rotations) -> (blocks, candidates)
+        distances = np.stack([d for d, _ in results], axis=2).reshape(rotated.shape[1], -1)
+        candidates = (np.stack([i for _, i in results], axis=2) * self.rotations + np.arange(self.rotations)).reshape(rotated.shape[1], -1)
+        return np.take_along_axis(candidates, best_ranked(distances, k), axis=1)
 
     def best_tile_from_block(self, tile_block_original, reuse=False):
         if not self.tiles:
@@ -141,17 +391,15 @@ class TileBox:
             raise KeyboardInterrupt
         
         #start_time = time.time()
-        i = self.best_tile_block_match(tile_block_original)
+        i = self.best_tile_block_match(tile_block_original)[0]
         #print("BLOCK MATCH took --- %s seconds ---" % (time.time() - start_time))
-        match = self.tiles[i].copy()
+        match = self.get_tile(i).copy()
         if not reuse:
-            if self.config.rotate:
-                indeces = [int(i/4)*4 + j for j in range(3,-1,-1)] # remove all rotated copies
-            else:
-                indeces = [i]
-            for j in indeces:
-                del self.tiles[j]
-            self.tile_array = np.delete(self.tile_array, indeces, axis=0)
+            n = i // self.rotations # removes all rotations of the tile
+            del self.tiles[n]
+            self.tile_u8 = np.delete(self.tile_u8, n, axis=0)
+            self.tile_sqnorms = np.delete(self.tile_sqnorms, n, axis=1)
+            self.__faiss_index = None
         return match
 
 class SourceImage:
@@ -165,7 +413,7 @@ class SourceImage:
             img = i.copy()
         w = int(img.size[0] * self.config.enlargement)
         h = int(img.size[1]	* self.config.enlargement)
-        large_img = img.resize((w, h), Image.ANTIALIAS)
+        large_img = img.resize((w, h), Image.LANCZOS)
         w_diff = (w % self.config.tile_width)/2
         h_diff = (h % self.config.tile_height)/2
         
@@ -177,6 +425,17 @@ class SourceImage:
         self.image =  large_img.convert(self.config.color_mode)
         print('Main image processed.')
 
+    def match_blocks(self, x_tile_count, y_tile_count):
+        """
+        Downsample the whole image to match resolution in one go and cut
+        it into flattened blocks, returned with shape (y, x, pixels).
+        """
+        match_width, match_height = self.config.match_size
+        grid = self.image.crop((0, 0, x_tile_count * self.config.tile_width, y_tile_count * self.config.tile_height))
+        small = downsample(grid, (x_tile_count * match_width, y_tile_count * match_height), self.config.color_mode)
+        blocks = small.reshape(y_tile_count, match_height, x_tile_count, match_width, -1).transpose(0, 2, 1, 3, 4)
+        return blocks.reshape(y_tile_count, x_tile_count, -1)
+
 class MosaicImage:
     """Holder for the mosaic"""
     def __init__(self, original_img, target, config):
@@ -198,7 +457,8 @@ class MosaicImage:
             print('Maybe the tiles are not the right size. ' + str(e))
 
     def save(self):
-        self.image.save(self.target)
+        # Fast PNG compression, mosaics are large and usually made in batches
+        self.image.save(self.target, compress_level=1)
 
 def coords_from_middle(x_count, y_count, y_bias=1, shuffle_first=0, ):
     '''
@@ -212,7 +472,10 @@ def coords_from_middle(x_count, y_count, y_bias=1, shuffle_first=0, ):
 
     shuffle_first - We can suffle the first X coords
         so that we dont use all the same-best images
-        in the same spot -  in the middle
+        in the same spot -  in the middle. The shuffle uses
+        np.random, so seed that (not random) for a repeatable order.
+
+    Returns an (x_count * y_count, 2) array of (x, y) coords.
 
     from movies.mosaic_mem import coords_from_middle
     x = 10
@@ -221,13 +484,17 @@ def coords_from_middle(x_count, y_count, y_bias=1, shuffle_first=0, ):
     '''
     x_mid = int(x_count/2)
     y_mid = int(y_count/2)
-    coords = list(itertools.product(range(x_count), range(y_count)))
-    coords.sort(key=lambda c: abs(c[0]-x_mid)*y_bias + abs(c[1]-y_mid))
-    coords = shuffle_first_items(coords, shuffle_first)
+    # Same x-major order as itertools.product, so the stable sort breaks ties the same way
+    xs, ys = np.mgrid[0:x_count, 0:y_count]
+    keys = np.abs(xs - x_mid)*y_bias + np.abs(ys - y_mid)
+    order = np.argsort(keys, axis=None, kind='stable')
+    coords = np.column_stack((xs.ravel()[order], ys.ravel()[order]))
+    if shuffle_first:
+        coords[:shuffle_first] = coords[np.random.permutation(len(coords[:shuffle_first]))]
     return coords
     
 
-def create_mosaic(source_path, target, tile_ratio=1920/800, tile_width=75, match_width=20, enlargement=8, reuse=True, color_mode='RGB', tile_paths=None, shuffle_first=30, rotate=False):
+def create_mosaic(source_path, target, tile_ratio=1920/800, tile_width=75, match_width=20, enlargement=8, reuse=True, color_mode='RGB', tile_paths=None, shuffle_first=30, rotate=False, tile_box=None, use_faiss=False):
     """Forms an mosiac from an original image using the best
     tiles provided. This reads, processes, and keeps in memory
     a copy of the source image, and all the tiles while processing.
@@ -244,6 +511,10 @@ def create_mosaic(source_path, target, tile_ratio=1920/800, tile_width=75, match
     shuffle_first -- Mosiac will be filled out starting in the center for best effect. Also, 
         we will shuffle the order of assessment so that all of our best images aren't 
         necessarily in one spot.
+    tile_box -- Already prepared TileBox to use instead of reading tile_paths, e.g. from
+        TileBox.load. It must have been made with the same tile and match settings.
+    use_faiss -- Search tiles with a FAISS index (needs faiss), only used for square tiles or
+        without rotation. Usually slower than the default numpy matching.
     """
     config = Config(
         tile_ratio = tile_ratio,		# height/width of mosaic tiles in pixels
@@ -251,6 +522,7 @@ def create_mosaic(source_path, target, tile_ratio=1920/800, tile_width=75, match
         enlargement = enlargement,	    # the mosaic image will be this many times wider and taller than the original
         color_mode = color_mode,	    # L for greyscale or RGB for color
         rotate = rotate,
+        use_faiss = use_faiss,
         match_width=match_width,
     )
     # Pull in and Process Original Image
@@ -262,59 +534,51 @@ def create_mosaic(source_path, target, tile_ratio=1920/800, tile_width=75, match
 
     # Assest Tiles, and save if needed, returns directories where the small and large pictures are stored
     print('Assessing Tiles')
-    tile_box = TileBox(tile_paths, config)
+    if tile_box is None:
+        tile_box = TileBox(tile_paths, config)
     
-    matches = list()
-    boxes = list()
     print("Matching tiles..\n")
-    
-    for x, y in tqdm(coords_from_middle(mosaic.x_tile_count, mosaic.y_tile_count, y_bias=config.tile_ratio, shuffle_first=shuffle_first)):
-        # Make a box for this sector
-        box_crop = (x * config.tile_width, y * config.tile_height, (x + 1) * config.tile_width, (y + 1) * config.tile_height)
-        
-        # Get Original Image Data for this Sector
-        comparison_block = source_image.image.crop(box_crop).resize([config.match_width, int(config.match_width/config.tile_ratio)])
-        
-        # Get Best Image name that matches the Orig Sector image
-        matches.append(tile_box.best_tile_block_match(comparison_block))
-        boxes.append(box_crop)
-        #tile_match = tile_box.best_tile_from_block(comparison_block, reuse=reuse)
+    coords = coords_from_middle(mosaic.x_tile_count, mosaic.y_tile_count, y_bias=config.tile_ratio, shuffle_first=shuffle_first)
+    xs, ys = coords.T
+    # Make a box for each sector
+    boxes = [(x * config.tile_width, y * config.tile_height, (x + 1) * config.tile_width, (y + 1) * config.tile_height) for x, y in coords.tolist()]
+
+    # Get Original Image Data for all Sectors and compare them against all tiles at once
+    blocks = source_image.match_blocks(mosaic.x_tile_count, mosaic.y_tile_count)[ys, xs]
+    if reuse:
+        matches = tile_box.best_block_matches(blocks, 1)[:, 0]
+    else:
+        available = np.ones(len(tile_box.tiles) * tile_box.rotations, dtype=np.bool_)
+        ranked = tile_box.best_block_matches(blocks, MATCH_CANDIDATES)
+        matches = np.full(len(ranked), -1, dtype=np.int64)
+        i = 0
+        while i < len(ranked):
+            i = greedy_assign(ranked, available, tile_box.rotations, matches, i) # remove all rotations of a tile
+            if i < len(ranked):
+                # The best candidates of this sector are all taken, use the best remaining tile
+                j = tile_box.best_available_match(blocks[i], available)
+                if j < 0:
+                    break
+                matches[i] = j
+                g = (j // tile_box.rotations) * tile_box.rotations
+                available[g:g + tile_box.rotations] = False
+                i += 1
 
     print("Assembling mosaic..\n")
-    available = set([i for i in range(len(tile_box.tiles))])
+    if (matches < 0).any():
+        print("Ran out of tiles!\n")
     
     try:
-        for i, m in enumerate(tqdm(matches)):
-            
-            if not available:
-                print("Ran out of tiles!\n")
-                mosaic.save()
-                break
-            
-            if not reuse:
-                j = next(j for j in m if j in available)
-                if config.rotate:
-                    indeces = [int(j/4)*4 + k for k in range(3,-1,-1)] # remove all rotated copies
-                else:
-                    indeces = [j]
-                #for k in indeces:
-                #    del available[available.index(k)]
-                available = available - set(indeces)
-            else:
-                j = m[0]
-            tile = tile_box.tiles[j].copy()
-            
-            # Add Best Match to Mosaic
-            mosaic.add_tile(tile, boxes[i])
-
-            # Saving Every Sector
-            #if i % 100 == 99: 
-            #    mosaic.save() 
+        # Matching is done, so paste in Z-order where consecutive tiles are close in the image
+        for i in tqdm(morton_order(xs, ys)):
+            j = matches[i]
+            if j < 0:
+                continue
+            # Add Best Match to Mosaic, paste only reads the tile so it needs no copy
+            mosaic.add_tile(tile_box.get_tile(j), boxes[i])
 
     except KeyboardInterrupt:
         print('\nStopping, saving partial image...')
 
     finally:
         mosaic.save()
-    
-    mosaic.save()